@@ -2,7 +2,12 @@ import subprocess
 import os
 import sys
 import argparse
+import hashlib
 import platform
+import shutil
+import signal
+import tempfile
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
 
 def get_default_blender_path():
     """
@@ -36,6 +41,197 @@ def get_default_blender_path():
     else:
         return 'blender'  # Generic fallback
 
+# Hardware AV1 encoders usable for the final encode of a rendered PNG sequence
+HW_ENCODERS = {
+    'nvenc': {
+        'encoder': 'av1_nvenc',
+        'input_args': [],
+        'output_args': ['-c:v', 'av1_nvenc', '-b:v', '10M'],
+    },
+    'vaapi': {
+        'encoder': 'av1_vaapi',
+        'input_args': ['-vaapi_device', '/dev/dri/renderD128'],
+        'output_args': ['-vf', 'format=nv12,hwupload', '-c:v', 'av1_vaapi'],
+    },
+}
+
+def ffmpeg_has_encoder(ffmpeg_path, encoder):
+    """
+    Check whether the given FFmpeg build lists the named encoder.
+    """
+    try:
+        result = subprocess.run([ffmpeg_path, '-hide_banner', '-encoders'], capture_output=True, text=True, check=True)
+    except (FileNotFoundError, subprocess.CalledProcessError):
+        return False
+    return any(line.split()[1:2] == [encoder] for line in result.stdout.splitlines())
+
+def get_low_priority_prefix():
+    """
+    Build a command prefix that lowers CPU and I/O priority on shared CI runners, where supported.
+    """
+    prefix = []
+    if shutil.which('ionice'):
+        prefix += ['ionice', '-c2', '-n7']
+    if shutil.which('nice'):
+        prefix += ['nice', '-n', '10']
+    return prefix
+
+def start_streamed(command, env=None):
+    """
+    Start a command at low priority with its combined output piped back for streaming.
+
+    Raises FileNotFoundError if the executable is missing.
+    """
+    if shutil.which(command[0]) is None:
+        raise FileNotFoundError(command[0])
+    return subprocess.Popen(get_low_priority_prefix() + command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            text=True, encoding='utf-8', errors='replace', bufsize=1, env=env, start_new_session=(os.name == 'posix'))
+
+def stream_output(proc, command, prefix=''):
+    """
+    Echo a started process's output line by line until it exits.
+
+    The process is terminated if streaming is interrupted (e.g. Ctrl-C), since its own
+    session does not receive the launcher's signals. Raises CalledProcessError on a non-zero exit.
+    """
+    try:
+        for line in proc.stdout:
+            print(prefix + line, end='', flush=True)
+        proc.wait()
+    except BaseException:
+        terminate_processes([proc])
+        proc.wait()
+        raise
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, command)
+
+def terminate_processes(processes):
+    """
+    Terminate every process in the list that is still running, along with its children.
+    """
+    for proc in processes:
+        if proc.poll() is None:
+            # poll() can miss a process another thread is reaping, so it may already be gone
+            try:
+                if os.name == 'posix':
+                    # Each process leads its own session, so signal the whole group
+                    os.killpg(proc.pid, signal.SIGTERM)
+                else:
+                    proc.terminate()
+            except ProcessLookupError:
+                pass
+
+def run_streamed(command, env=None, prefix=''):
+    """
+    Run a command at low priority, streaming its combined output line by line.
+
+    Raises FileNotFoundError if the executable is missing and CalledProcessError on a non-zero exit.
+    """
+    stream_output(start_streamed(command, env), command, prefix)
+
+# Software encoders for the final encode of a rendered PNG sequence, keyed by Blender codec name
+SOFTWARE_ENCODERS = {
+    # SVT-AV1 preset 8 is far faster than Blender's built-in libaom path at a small quality cost
+    'AV1': ['-c:v', 'libsvtav1', '-preset', '8', '-svtav1-params', 'tune=0:enable-overlays=1'],
+    'H264': ['-c:v', 'libx264'],
+    'H265': ['-c:v', 'libx265'],
+    # Blender calls its VP9 codec WEBM; -b:v 0 makes -crf constant quality rather than a bitrate cap
+    'WEBM': ['-c:v', 'libvpx-vp9', '-b:v', '0'],
+}
+
+# FFmpeg muxer names for Blender's container names
+FFMPEG_CONTAINER_FORMATS = {
+    'MKV': 'matroska',
+    'MP4': 'mp4',
+    'MPEG4': 'mp4',
+    'WEBM': 'webm',
+    'MOV': 'mov',
+    'QUICKTIME': 'mov',
+    'AVI': 'avi',
+    'OGG': 'ogg',
+    'FLASH': 'flv',
+}
+
+def build_encode_command(ffmpeg_path, frames_pattern, fps, total_frames, container, output_path, input_args=(), output_args=()):
+    """
+    Build the FFmpeg command that encodes a rendered PNG sequence into the final video.
+    """
+    return [ffmpeg_path, '-y'] + list(input_args) + [
+        '-framerate', str(fps),
+        '-start_number', '1',
+        '-i', frames_pattern,
+        '-frames:v', str(total_frames),
+    ] + list(output_args) + [
+        '-f', FFMPEG_CONTAINER_FORMATS.get(container.upper(), container.lower()),
+        output_path,
+    ]
+
+def get_blender_version(blender_path):
+    """
+    Return the version banner printed by 'blender --version', or an empty string if it cannot be run.
+    """
+    try:
+        result = subprocess.run([blender_path, '--version'], capture_output=True, text=True, check=True)
+    except (FileNotFoundError, subprocess.CalledProcessError):
+        return ''
+    return result.stdout.strip()
+
+def get_scene_cache_path(cache_path, input_script, blender_path):
+    """
+    Derive a cache file name keyed on the scene script's contents and the Blender build,
+    so editing the script or switching Blender versions invalidates it.
+    """
+    digest = hashlib.sha256()
+    with open(input_script, 'rb') as f:
+        digest.update(f.read())
+    digest.update(os.path.abspath(blender_path).encode())
+    digest.update(get_blender_version(blender_path).encode())
+    root, ext = os.path.splitext(cache_path)
+    return root + "-" + digest.hexdigest()[:12] + (ext or ".blend")
+
+# Blender's constant_rate_factor presets and the x264 CRF each one corresponds to
+BLENDER_CRF_PRESETS = {
+    'LOSSLESS': 0,
+    'PERC_LOSSLESS': 17,
+    'HIGH': 20,
+    'MEDIUM': 23,
+    'LOW': 26,
+    'VERYLOW': 29,
+    'LOWEST': 32,
+}
+
+def get_blender_crf_preset(crf):
+    """
+    Map a numeric CRF to the closest of Blender's constant_rate_factor presets.
+    """
+    try:
+        crf_number = int(crf)
+    except ValueError:
+        return crf.upper()  # Already a preset name
+    return min(BLENDER_CRF_PRESETS, key=lambda preset: abs(BLENDER_CRF_PRESETS[preset] - crf_number))
+
+def get_numeric_crf(crf):
+    """
+    Map a Blender constant_rate_factor preset name to its numeric CRF for FFmpeg; numbers pass through.
+    """
+    if crf.upper() in BLENDER_CRF_PRESETS:
+        return str(BLENDER_CRF_PRESETS[crf.upper()])
+    return crf
+
+def split_frame_range(total_frames, workers):
+    """
+    Split frames 1..total_frames into contiguous (start, end) chunks, one per worker.
+    """
+    workers = max(1, min(workers, total_frames))
+    chunk_size, remainder = divmod(total_frames, workers)
+    chunks = []
+    start = 1
+    for i in range(workers):
+        end = start + chunk_size - 1 + (1 if i < remainder else 0)
+        chunks.append((start, end))
+        start = end + 1
+    return chunks
+
 def main():
     """
     Constructs and executes a headless Blender render command based on CLI arguments.
@@ -56,9 +252,16 @@ def main():
     parser.add_argument('--container', type=str, default='MKV', help='FFmpeg container (e.g., MKV, MP4).')
     parser.add_argument('--codec', type=str, default='AV1', help='FFmpeg video codec (e.g., AV1, H264).')
     parser.add_argument('--crf', type=str, default='20', help='Constant Rate Factor for video quality (lower is better).')
+    parser.add_argument('--hw-encoder', type=str, default='none', choices=['none'] + list(HW_ENCODERS), help='Render a PNG sequence and encode it to AV1 with a hardware encoder instead of Blender\'s FFmpeg writer.')
+    parser.add_argument('--ffmpeg-path', type=str, default='ffmpeg', help='Path to the FFmpeg executable used to encode rendered PNG sequences.')
+    parser.add_argument('--scene-cache', type=str, default=None, help='Save the generated scene as a .blend file at this path (suffixed with a hash of the input script and Blender version) and reuse it on later runs.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of Blender processes rendering frame chunks in parallel. More than one renders a PNG sequence encoded by FFmpeg.')
 
     args = parser.parse_args()
 
+    # Echoing child output must never fail on characters the console encoding cannot represent
+    sys.stdout.reconfigure(errors='replace')
+
     print("--- Starting CI/CD Render Pipeline with CLI Arguments ---")
     print("Detected OS: " + platform.system())
     print("Default Blender path: " + default_blender_path)
@@ -74,47 +277,140 @@ def main():
         os.makedirs(output_dir, exist_ok=True)
         
     render_output_path_arg = os.path.join(os.getcwd(), args.output_path)
+    render_format = "FFMPEG"
+
+    # Use a hardware encoder only if this FFmpeg build actually provides it
+    use_hw_encoder = False
+    if args.hw_encoder != 'none':
+        hw_encoder_name = HW_ENCODERS[args.hw_encoder]['encoder']
+        if ffmpeg_has_encoder(args.ffmpeg_path, hw_encoder_name):
+            print("Hardware encoder available: " + hw_encoder_name)
+            use_hw_encoder = True
+        else:
+            print("Warning: " + hw_encoder_name + " not available in '" + args.ffmpeg_path + "', falling back to software encoding.")
+
+    # AV1, parallel workers and hardware encoding all render a PNG sequence and hand it to FFmpeg afterwards
+    use_frames = use_hw_encoder or args.workers > 1 or args.codec == 'AV1'
+    if use_frames:
+        if use_hw_encoder:
+            encoder_input_args = HW_ENCODERS[args.hw_encoder]['input_args']
+            encoder_output_args = HW_ENCODERS[args.hw_encoder]['output_args']
+        elif args.codec in SOFTWARE_ENCODERS:
+            # Fail before rendering rather than after, if FFmpeg cannot encode the result
+            software_encoder_name = SOFTWARE_ENCODERS[args.codec][1]
+            if not ffmpeg_has_encoder(args.ffmpeg_path, software_encoder_name):
+                print("Error: FFmpeg encoder " + software_encoder_name + " not available in '" + args.ffmpeg_path + "'")
+                sys.exit(1)
+            encoder_input_args = []
+            # PNG frames are RGB(A); force 4:2:0 so the output plays in common players and browsers
+            encoder_output_args = SOFTWARE_ENCODERS[args.codec] + ['-pix_fmt', 'yuv420p', '-crf', get_numeric_crf(args.crf)]
+        else:
+            print("Error: Codec '" + args.codec + "' is not supported for PNG sequence encoding (supported: " + ", ".join(SOFTWARE_ENCODERS) + ")")
+            sys.exit(1)
+        # Render into a fresh directory owned by this run so frames from other runs are never encoded
+        frames_dir = tempfile.mkdtemp(prefix=os.path.basename(args.output_path) + ".frames-", dir=output_dir or ".")
+        render_format = "PNG"
+        render_output_path_arg = os.path.join(os.path.abspath(frames_dir), "frame_######")
+        frames_pattern = os.path.join(frames_dir, "frame_%06d.png")
     
     # Calculate total frames
     total_frames = args.fps * args.duration
     
-    # Map CRF values to Blender's enum values for different codecs
-    if args.codec == 'AV1':
-        # AV1 codec uses quality presets, not numeric CRF
-        crf_value = 'MEDIUM'  # Options: LOSSLESS, PERC_LOSSLESS, HIGH, MEDIUM, LOW, VERYLOW, LOWEST
+    # Share the CPU between parallel workers instead of oversubscribing it
+    if args.workers > 1:
+        threads = str(max(1, (os.cpu_count() or 1) // args.workers))
     else:
-        # For other codecs like H264, use the numeric CRF value
-        crf_value = args.crf
+        threads = "0"  # Use all available CPU threads
+    # Keep OpenMP-backed code in Blender at the same thread budget
+    blender_env = {**os.environ, "OMP_NUM_THREADS": threads if threads != "0" else str(os.cpu_count() or 1)}
+
+    # Load a cached scene instead of regenerating it, building the cache first if needed
+    scene_args = ["--python", args.input_script]
+    if args.scene_cache:
+        cache_path = os.path.abspath(get_scene_cache_path(args.scene_cache, args.input_script, args.blender_path))
+        if os.path.exists(cache_path):
+            print("Using cached scene: " + cache_path)
+        else:
+            cache_dir = os.path.dirname(cache_path)
+            os.makedirs(cache_dir, exist_ok=True)
+            build_command = [args.blender_path, "--background", "--threads", "0", "--python-exit-code", "1", "--python", args.input_script]
+            print("\nBuilding scene cache: " + cache_path)
+            print(" ".join(build_command))
+            try:
+                run_streamed(build_command, env={**blender_env, "SCENE_CACHE": cache_path})
+            except FileNotFoundError:
+                print("\n--- ERROR: Blender executable not found at '" + args.blender_path + "'. ---")
+                sys.exit(1)
+            except subprocess.CalledProcessError:
+                print("\n--- ERROR: Blender returned a non-zero exit code while building the scene cache. ---")
+                sys.exit(1)
+            if not os.path.exists(cache_path):
+                print("\n--- ERROR: Scene cache was not written to '" + cache_path + "'. ---")
+                sys.exit(1)
+        scene_args = [cache_path]
+
+    # Scene settings injected into Blender, applied in a single python expression
+    settings = [
+        "s.render.resolution_x = " + str(args.width),
+        "s.render.resolution_y = " + str(args.height),
+        "s.render.fps = " + str(args.fps),
+        "s.frame_end = " + str(total_frames),
+        "s.render.threads_mode = 'AUTO'",
+    ]
+    if render_format == "FFMPEG":
+        # Blender's FFmpeg writer only accepts quality presets, not numeric CRF values
+        settings += [
+            "s.render.ffmpeg.format = '" + args.container + "'",
+            "s.render.ffmpeg.codec = '" + args.codec + "'",
+            "s.render.ffmpeg.constant_rate_factor = '" + get_blender_crf_preset(args.crf) + "'",
+            "s.render.ffmpeg.audio_codec = 'NONE'",
+        ]
+    settings_expr = "import bpy; s = bpy.context.scene; " + "; ".join(settings)
 
     # Build the command with settings from arguments
     command = [
         args.blender_path,
         "--background",
-        "--python", args.input_script,
-        "--render-format", "FFMPEG",
+        "--threads", threads,
+        "--python-exit-code", "1",  # Fail the run if the scene script or the settings expression raises
+    ] + scene_args + [
+        "--render-format", render_format,
         "--render-output", render_output_path_arg,
-        
-        # Use python expressions to inject settings into the Blender scene
-        "--python-expr", "import bpy; bpy.context.scene.render.resolution_x = " + str(args.width),
-        "--python-expr", "import bpy; bpy.context.scene.render.resolution_y = " + str(args.height),
-        "--python-expr", "import bpy; bpy.context.scene.render.fps = " + str(args.fps),
-        "--python-expr", "import bpy; bpy.context.scene.frame_end = " + str(total_frames),
-        "--python-expr", "import bpy; bpy.context.scene.render.ffmpeg.format = '" + args.container + "'",
-        "--python-expr", "import bpy; bpy.context.scene.render.ffmpeg.codec = '" + args.codec + "'",
-        "--python-expr", "import bpy; bpy.context.scene.render.ffmpeg.constant_rate_factor = '" + crf_value + "'",
-        
-        "--render-anim"
+        "--python-expr", settings_expr,
     ]
 
-    print("\nExecuting Blender command:")
-    print(" ".join(command))
+    if args.workers > 1:
+        # Frame range flags must follow the settings expression above to override its frame_end
+        commands = [command + ["--frame-start", str(start), "--frame-end", str(end), "--render-anim"]
+                    for start, end in split_frame_range(total_frames, args.workers)]
+    else:
+        commands = [command + ["--render-anim"]]
+
+    print("\nExecuting Blender command" + ("s:" if len(commands) > 1 else ":"))
+    for worker_command in commands:
+        print(" ".join(worker_command))
     print("\n--- Blender Output ---")
 
+    processes = []
     try:
-        subprocess.run(command, check=True)
+        with ThreadPoolExecutor(max_workers=len(commands)) as executor:
+            # Terminate inside the executor block; leaving it waits for every streaming thread
+            try:
+                # Start every worker up front so all of them can be stopped if one fails
+                for worker_command in commands:
+                    processes.append(start_streamed(worker_command, blender_env))
+                # Tag each line with its worker so interleaved output stays readable
+                prefixes = ["[worker " + str(i) + "] " if len(commands) > 1 else "" for i in range(len(commands))]
+                futures = [executor.submit(stream_output, proc, worker_command, prefix)
+                           for proc, worker_command, prefix in zip(processes, commands, prefixes)]
+                done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+                for future in done:
+                    if future.exception() is not None:
+                        raise future.exception()
+            except BaseException:
+                terminate_processes(processes)
+                raise
         print("--- End of Blender Output ---\n")
-        print("SUCCESS: Render complete.")
-        print("Video saved to: " + args.output_path)
 
     except FileNotFoundError:
         print("\n--- ERROR: Blender executable not found at '" + args.blender_path + "'. ---")
@@ -124,5 +420,23 @@ def main():
         print("\n--- ERROR: Blender returned a non-zero exit code. ---")
         sys.exit(1)
 
+    if use_frames:
+        encode_command = build_encode_command(args.ffmpeg_path, frames_pattern, args.fps, total_frames, args.container, args.output_path, encoder_input_args, encoder_output_args)
+        print("Executing FFmpeg command:")
+        print(" ".join(encode_command))
+        try:
+            run_streamed(encode_command)
+        except FileNotFoundError:
+            print("\n--- ERROR: FFmpeg executable not found at '" + args.ffmpeg_path + "'. ---")
+            sys.exit(1)
+        except subprocess.CalledProcessError:
+            print("\n--- ERROR: FFmpeg returned a non-zero exit code. Rendered frames kept in '" + frames_dir + "'. ---")
+            sys.exit(1)
+        # The intermediate PNGs can take tens of gigabytes at 4K
+        shutil.rmtree(frames_dir)
+
+    print("SUCCESS: Render complete.")
+    print("Video saved to: " + args.output_path)
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
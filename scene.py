@@ -9,8 +9,9 @@
 import bpy # type: ignore
 import bmesh # type: ignore
 import math
-import random
-from mathutils import Vector # type: ignore
+import os
+import numpy as np
+from mathutils import Matrix, Vector # type: ignore
 
 # --- CONFIGURATION PARAMETERS ---
 GRID_SIZE_X = 32
@@ -22,6 +23,10 @@ SPACING = 1.5
 COOLING_PLATE_THICKNESS = 0.05
 NUM_PACKETS = 30
 PACKET_TRAVEL_TIME = 10
+# Below this many packets the Numba JIT compile costs more than the vectorized NumPy path saves
+NUMBA_MIN_PACKETS = 10000
+# Fixed seed so parallel render workers and scene caches see identical scenes
+RANDOM_SEED = 42
 
 # --- UTILITY FUNCTIONS ---
 
@@ -30,16 +35,25 @@ def clean_scene():
         bpy.ops.object.mode_set(mode='OBJECT')
     bpy.ops.object.select_all(action='SELECT')
     bpy.ops.object.delete()
-    for item in bpy.data.meshes: bpy.data.meshes.remove(item)
-    for item in bpy.data.materials: bpy.data.materials.remove(item)
-    for item in bpy.data.actions: bpy.data.actions.remove(item)
-    for item in bpy.data.collections:
-        if item.name != "Scene Collection":
-            bpy.data.collections.remove(item)
+    collections = [item for item in bpy.data.collections if item.name != "Scene Collection"]
+    bpy.data.batch_remove(list(bpy.data.meshes) + list(bpy.data.materials) + list(bpy.data.actions)
+                          + list(bpy.data.node_groups) + collections)
 
 def get_core_position(x, y, z):
     return Vector((x * SPACING, y * SPACING, z * SPACING))
 
+def insert_keyframes(action, data_path, index, frames, values, interpolation=None):
+    """Write a whole F-Curve in one bulk call instead of per-key keyframe_insert"""
+    fcurve = action.fcurves.new(data_path, index=index)
+    fcurve.keyframe_points.add(len(frames))
+    co = np.column_stack((frames, values)).astype(np.float32)
+    fcurve.keyframe_points.foreach_set("co", co.ravel())
+    if interpolation:
+        for keyframe in fcurve.keyframe_points:
+            keyframe.interpolation = interpolation
+    fcurve.update()
+    return fcurve
+
 def create_material(name, color, alpha=1.0, emission_color=(0,0,0,1), emission_strength=1.0, metallic=0.0, roughness=0.5):
     mat = bpy.data.materials.new(name=name)
     mat.use_nodes = True
@@ -81,23 +95,48 @@ def create_base_models():
     core_obj.data.materials.append(MAT_CORE)
     router_obj = create_primitive("Base_NoCRouter", base_model_coll, 'SPHERE', radius=ROUTER_SIZE, u_segments=16, v_segments=8)
     router_obj.data.materials.append(MAT_ROUTER)
+    # Shared by every packet; each packet overrides the material on its own object
+    packet_obj = create_primitive("Base_Packet", base_model_coll, 'SPHERE', radius=0.3, u_segments=8, v_segments=4)
+    packet_obj.data.materials.append(MAT_PACKETS[0])
     base_model_coll.hide_render = True
     base_model_coll.hide_viewport = True
-    return core_obj, router_obj
+    return core_obj, router_obj, packet_obj
+
+def create_instance_node_group(name, instance_obj):
+    """Geometry Nodes tree that places a copy of instance_obj on every vertex"""
+    node_group = bpy.data.node_groups.new(name, 'GeometryNodeTree')
+    node_group.interface.new_socket("Geometry", in_out='INPUT', socket_type='NodeSocketGeometry')
+    node_group.interface.new_socket("Geometry", in_out='OUTPUT', socket_type='NodeSocketGeometry')
+    nodes = node_group.nodes
+    group_input = nodes.new("NodeGroupInput")
+    mesh_to_points = nodes.new("GeometryNodeMeshToPoints")
+    object_info = nodes.new("GeometryNodeObjectInfo")
+    object_info.inputs["Object"].default_value = instance_obj
+    instance_on_points = nodes.new("GeometryNodeInstanceOnPoints")
+    group_output = nodes.new("NodeGroupOutput")
+    links = node_group.links
+    links.new(group_input.outputs["Geometry"], mesh_to_points.inputs["Mesh"])
+    links.new(mesh_to_points.outputs["Points"], instance_on_points.inputs["Points"])
+    links.new(object_info.outputs["Geometry"], instance_on_points.inputs["Instance"])
+    links.new(instance_on_points.outputs["Instances"], group_output.inputs["Geometry"])
+    return node_group
 
 def create_grid(core_base, router_base):
     grid_coll = bpy.data.collections.new("ForthGrid")
     bpy.context.scene.collection.children.link(grid_coll)
-    for z in range(GRID_SIZE_Z):
-        for y in range(GRID_SIZE_Y):
-            for x in range(GRID_SIZE_X):
-                pos = get_core_position(x, y, z)
-                core_inst = bpy.data.objects.new(f"Core_{x}_{y}_{z}", core_base.data)
-                core_inst.location = pos
-                grid_coll.objects.link(core_inst)
-                router_inst = bpy.data.objects.new(f"Router_{x}_{y}_{z}", router_base.data)
-                router_inst.location = pos
-                grid_coll.objects.link(router_inst)
+    xs, ys, zs = np.meshgrid(np.arange(GRID_SIZE_X), np.arange(GRID_SIZE_Y), np.arange(GRID_SIZE_Z), indexing='ij')
+    locs = np.stack([xs, ys, zs], axis=-1).reshape(-1, 3).astype(np.float32) * SPACING
+    # One vertex per grid position; cores and routers are instanced onto them so
+    # the whole grid is two objects instead of one per core and router
+    points_mesh = bpy.data.meshes.new("GridPoints_Mesh")
+    points_mesh.vertices.add(len(locs))
+    points_mesh.vertices.foreach_set("co", locs.ravel())
+    points_mesh.update()
+    for name, base in (("Cores", core_base), ("Routers", router_base)):
+        grid_obj = bpy.data.objects.new(name, points_mesh)
+        modifier = grid_obj.modifiers.new(name + "_Instances", 'NODES')
+        modifier.node_group = create_instance_node_group(name + "_Instancer", base)
+        grid_coll.objects.link(grid_obj)
 
 def create_chiplets():
     chiplet_coll = bpy.data.collections.new("Chiplets")
@@ -114,66 +153,109 @@ def create_chiplets():
 def create_cooling_grid():
     cooling_coll = bpy.data.collections.new("CoolingGrid")
     bpy.context.scene.collection.children.link(cooling_coll)
-    plate_mesh = bpy.data.meshes.new("BasePlate_Mesh")
-    bm = bmesh.new()
-    bmesh.ops.create_cube(bm, size=1)
-    bm.to_mesh(plate_mesh)
-    bm.free()
-    plate_mesh.materials.append(MAT_COOLING_PLATE)
     grid_width = (GRID_SIZE_X - 1) * SPACING
     grid_depth = (GRID_SIZE_Y - 1) * SPACING
     grid_height = (GRID_SIZE_Z - 1) * SPACING
+    plates = []
     for z in range(GRID_SIZE_Z - 1):
-        plate_obj = bpy.data.objects.new(f"Plate_Z_{z}", plate_mesh)
-        plate_obj.location = get_core_position(grid_width / (2*SPACING), grid_depth / (2*SPACING), z + 0.5)
-        plate_obj.scale = (grid_width + SPACING, grid_depth + SPACING, COOLING_PLATE_THICKNESS)
-        cooling_coll.objects.link(plate_obj)
+        plates.append((get_core_position(grid_width / (2*SPACING), grid_depth / (2*SPACING), z + 0.5),
+                       (grid_width + SPACING, grid_depth + SPACING, COOLING_PLATE_THICKNESS)))
     for y in range(GRID_SIZE_Y - 1):
-        plate_obj = bpy.data.objects.new(f"Plate_Y_{y}", plate_mesh)
-        plate_obj.location = get_core_position(grid_width / (2*SPACING), y + 0.5, grid_height / (2*SPACING))
-        plate_obj.scale = (grid_width + SPACING, COOLING_PLATE_THICKNESS, grid_height + SPACING)
-        cooling_coll.objects.link(plate_obj)
+        plates.append((get_core_position(grid_width / (2*SPACING), y + 0.5, grid_height / (2*SPACING)),
+                       (grid_width + SPACING, COOLING_PLATE_THICKNESS, grid_height + SPACING)))
     for x in range(GRID_SIZE_X - 1):
-        plate_obj = bpy.data.objects.new(f"Plate_X_{x}", plate_mesh)
-        plate_obj.location = get_core_position(x + 0.5, grid_depth / (2*SPACING), grid_height / (2*SPACING))
-        plate_obj.scale = (COOLING_PLATE_THICKNESS, grid_depth + SPACING, grid_height + SPACING)
-        cooling_coll.objects.link(plate_obj)
+        plates.append((get_core_position(x + 0.5, grid_depth / (2*SPACING), grid_height / (2*SPACING)),
+                       (COOLING_PLATE_THICKNESS, grid_depth + SPACING, grid_height + SPACING)))
+    # Plates never move, so bake them all into one mesh instead of one object per plate
+    bm = bmesh.new()
+    for location, scale in plates:
+        matrix = Matrix.Translation(location) @ Matrix.Diagonal(scale).to_4x4()
+        bmesh.ops.create_cube(bm, size=1, matrix=matrix)
+    plate_mesh = bpy.data.meshes.new("CoolingPlates_Mesh")
+    bm.to_mesh(plate_mesh)
+    bm.free()
+    plate_mesh.materials.append(MAT_COOLING_PLATE)
+    plate_obj = bpy.data.objects.new("CoolingPlates", plate_mesh)
+    cooling_coll.objects.link(plate_obj)
 
 # --- ANIMATION FUNCTIONS ---
 
-def create_packet(name, start_frame, collection, material):
-    packet = create_primitive(name, collection, 'SPHERE', radius=0.3, u_segments=16, v_segments=8)
-    packet.data.materials.append(material)
-    packet.hide_viewport = True
-    packet.hide_render = True
-    packet.keyframe_insert(data_path="hide_viewport", frame=start_frame - 1)
-    packet.keyframe_insert(data_path="hide_render", frame=start_frame - 1)
-    packet.hide_viewport = False
-    packet.hide_render = False
-    packet.keyframe_insert(data_path="hide_viewport", frame=start_frame)
-    packet.keyframe_insert(data_path="hide_render", frame=start_frame)
+def create_packet(name, collection, packet_mesh, material):
+    packet = bpy.data.objects.new(name, packet_mesh)
+    collection.objects.link(packet)
+    packet.material_slots[0].link = 'OBJECT'
+    packet.material_slots[0].material = material
     return packet
 
-def animate_packet_route(packet, start_frame, start_coord, end_coord, anim_end_frame):
-    current_frame = start_frame
-    packet.location = get_core_position(start_coord[0], start_coord[1], start_coord[2])
-    packet.keyframe_insert(data_path="location", frame=current_frame)
-    dist_x = abs(end_coord[0] - start_coord[0])
-    dist_y = abs(end_coord[1] - start_coord[1])
-    dist_z = abs(end_coord[2] - start_coord[2])
-    frame_after_x = start_frame + dist_x * PACKET_TRAVEL_TIME
-    packet.location = get_core_position(end_coord[0], start_coord[1], start_coord[2])
-    packet.keyframe_insert(data_path="location", frame=frame_after_x)
-    frame_after_y = frame_after_x + dist_y * PACKET_TRAVEL_TIME
-    packet.location = get_core_position(end_coord[0], end_coord[1], start_coord[2])
-    packet.keyframe_insert(data_path="location", frame=frame_after_y)
-    frame_after_z = frame_after_y + dist_z * PACKET_TRAVEL_TIME
-    packet.location = get_core_position(end_coord[0], end_coord[1], end_coord[2])
-    packet.keyframe_insert(data_path="location", frame=frame_after_z)
-    packet.hide_viewport = True
-    packet.hide_render = True
-    packet.keyframe_insert(data_path="hide_viewport", frame=frame_after_z + 1)
-    packet.keyframe_insert(data_path="hide_render", frame=frame_after_z + 1)
+def _compute_routes_numpy(starts, ends, start_frames, spacing, travel):
+    dists = np.abs(ends - starts)
+    frames = np.empty((len(starts), 4), dtype=np.float32)
+    frames[:, 0] = start_frames
+    frames[:, 1:] = start_frames[:, None] + np.cumsum(dists, axis=1) * travel
+    coords = np.empty((len(starts), 4, 3), dtype=np.float32)
+    for waypoint in range(4):
+        # Axes before the current waypoint have already reached their destination
+        coords[:, waypoint, :waypoint] = ends[:, :waypoint]
+        coords[:, waypoint, waypoint:] = starts[:, waypoint:]
+    return coords * spacing, frames
+
+def _load_routes_jit():
+    """Parallel Numba route kernel, or None when Numba is not installed.
+
+    Numba is optional (Blender's bundled Python does not ship it) and slow to import,
+    so it is only imported once the packet count makes it worthwhile.
+    """
+    try:
+        from numba import njit, prange # type: ignore
+    except ImportError:
+        return None
+
+    @njit(parallel=True, cache=True)
+    def compute_routes_jit(starts, ends, start_frames, spacing, travel):
+        n = starts.shape[0]
+        frames = np.empty((n, 4), dtype=np.float32)
+        coords = np.empty((n, 4, 3), dtype=np.float32)
+        for i in prange(n):
+            frame = start_frames[i]
+            frames[i, 0] = frame
+            for waypoint in range(4):
+                for axis in range(3):
+                    coord = ends[i, axis] if axis < waypoint else starts[i, axis]
+                    coords[i, waypoint, axis] = coord * spacing
+                if waypoint < 3:
+                    frame += abs(ends[i, waypoint] - starts[i, waypoint]) * travel
+                    frames[i, waypoint + 1] = frame
+        return coords, frames
+
+    return compute_routes_jit
+
+def compute_routes(starts, ends, start_frames, spacing, travel):
+    """Dimension-ordered (X, then Y, then Z) routes for all packets at once.
+
+    Returns waypoint locations of shape (N, 4, 3) and keyframe numbers of shape (N, 4).
+    Uses a Numba-compiled loop for large packet counts when Numba is installed,
+    vectorized NumPy otherwise.
+    """
+    if len(starts) >= NUMBA_MIN_PACKETS:
+        compute_routes_jit = _load_routes_jit()
+        if compute_routes_jit is not None:
+            return compute_routes_jit(starts, ends, start_frames, spacing, travel)
+    return _compute_routes_numpy(starts, ends, start_frames, spacing, travel)
+
+def animate_packet_route(packet, frames, coords):
+    action = bpy.data.actions.new(packet.name + "_Action")
+    action.id_root = 'OBJECT'
+    # Zero-length legs repeat the previous waypoint on the same frame; keep one key per frame
+    keep = np.concatenate(([True], np.diff(frames) > 0))
+    frames, coords = frames[keep], coords[keep]
+    for axis in range(3):
+        insert_keyframes(action, "location", axis, frames, coords[:, axis])
+    # Visible from the first waypoint until one frame after the last
+    visibility_frames = (frames[0] - 1, frames[0], frames[-1] + 1)
+    for data_path in ("hide_viewport", "hide_render"):
+        insert_keyframes(action, data_path, 0, visibility_frames, (1, 0, 1), interpolation='CONSTANT')
+    packet.animation_data_create()
+    packet.animation_data.action = action
 
 # --- TEXT ANIMATION FUNCTIONS ---
 
@@ -270,10 +352,53 @@ def create_marketing_text_sequence(anim_end_frame):
     
     print(f"Created {len(messages)} marketing text messages")
 
+# --- RENDER SETTINGS ---
+
+def setup_compositor_bloom(scene, threshold, mix, size):
+    """Bloom via a compositor Glare node, replacing Eevee's legacy bloom settings"""
+    scene.use_nodes = True
+    tree = scene.node_tree
+    tree.nodes.clear()
+    render_layers = tree.nodes.new("CompositorNodeRLayers")
+    glare = tree.nodes.new("CompositorNodeGlare")
+    glare.glare_type = 'BLOOM'
+    glare.threshold = threshold
+    glare.mix = mix
+    glare.size = size
+    composite = tree.nodes.new("CompositorNodeComposite")
+    tree.links.new(render_layers.outputs["Image"], glare.inputs["Image"])
+    tree.links.new(glare.outputs["Image"], composite.inputs["Image"])
+
+def setup_render_engine(scene):
+    """Select Eevee (Next on Blender 4.2+) and configure sampling and bloom"""
+    if bpy.app.version >= (4, 2, 0):
+        scene.render.engine = 'BLENDER_EEVEE_NEXT'
+        # Temporal accumulation converges quickly on this mostly static grid
+        scene.eevee.taa_render_samples = 16
+        scene.eevee.use_motion_blur = False
+        # No reflective or volumetric surfaces in the scene, and a single sun light
+        scene.eevee.use_raytracing = False
+        scene.eevee.use_volumetric_shadows = False
+        scene.eevee.shadow_resolution_scale = 0.5
+        setup_compositor_bloom(scene, threshold=1.0, mix=-0.9, size=7)
+    else:
+        scene.render.engine = 'BLENDER_EEVEE'
+        scene.eevee.taa_render_samples = 16
+        scene.eevee.use_ssr = False
+        scene.eevee.use_volumetric_lights = False
+        scene.eevee.use_volumetric_shadows = False
+        scene.eevee.shadow_cube_size = '512'
+        scene.eevee.shadow_cascade_size = '1024'
+        scene.eevee.use_bloom = True
+        scene.eevee.bloom_threshold = 1.0
+        scene.eevee.bloom_intensity = 0.08
+        scene.eevee.bloom_radius = 7
+
 # --- MAIN EXECUTION ---
 
 if __name__ == "__main__":
     print("--- Starting Scene Generation ---")
+    rng = np.random.default_rng(RANDOM_SEED)
     clean_scene()
 
     # Note: FPS, Resolution, and Frame Range are now set by the launcher script.
@@ -292,7 +417,7 @@ if __name__ == "__main__":
 
     # --- Create Geometry ---
     print("Creating base models...")
-    core_base, router_base = create_base_models()
+    core_base, router_base, packet_base = create_base_models()
     print("Creating core grid...")
     create_grid(core_base, router_base)
     print("Creating chiplet casing...")
@@ -304,17 +429,20 @@ if __name__ == "__main__":
     print(f"Generating {NUM_PACKETS} random packet animations...")
     anim_coll = bpy.data.collections.new("AnimationObjects")
     bpy.context.scene.collection.children.link(anim_coll)
+    grid_max = np.array([GRID_SIZE_X, GRID_SIZE_Y, GRID_SIZE_Z])
+    starts = rng.integers(0, grid_max, size=(NUM_PACKETS, 3))
+    ends = rng.integers(0, grid_max, size=(NUM_PACKETS, 3))
+    # Nudge any packet that would start at its destination one core along X
+    dup = (starts == ends).all(axis=1)
+    ends[dup, 0] = (ends[dup, 0] + 1) % GRID_SIZE_X
+    # Ensure start_frame is within valid range
+    max_start_frame = max(0, int(anim_end_frame) - 500)
+    start_frames = rng.integers(0, max_start_frame, size=NUM_PACKETS, endpoint=True)
+    packet_mats = rng.integers(0, len(MAT_PACKETS), size=NUM_PACKETS)
+    route_coords, route_frames = compute_routes(starts, ends, start_frames, SPACING, PACKET_TRAVEL_TIME)
     for i in range(NUM_PACKETS):
-        start_coord = (random.randint(0, GRID_SIZE_X-1), random.randint(0, GRID_SIZE_Y-1), random.randint(0, GRID_SIZE_Z-1))
-        end_coord = (random.randint(0, GRID_SIZE_X-1), random.randint(0, GRID_SIZE_Y-1), random.randint(0, GRID_SIZE_Z-1))
-        while start_coord == end_coord:
-            end_coord = (random.randint(0, GRID_SIZE_X-1), random.randint(0, GRID_SIZE_Y-1), random.randint(0, GRID_SIZE_Z-1))
-        # Ensure start_frame is within valid range
-        max_start_frame = max(0, int(anim_end_frame) - 500)
-        start_frame = random.randint(0, max_start_frame) if max_start_frame > 0 else 0
-        packet_mat = random.choice(MAT_PACKETS)
-        packet = create_packet(f"Packet_{i}", start_frame, anim_coll, packet_mat)
-        animate_packet_route(packet, start_frame, start_coord, end_coord, anim_end_frame)
+        packet = create_packet(f"Packet_{i}", anim_coll, packet_base.data, MAT_PACKETS[packet_mats[i]])
+        animate_packet_route(packet, route_frames[i], route_coords[i])
 
     # --- Create Marketing Text Sequence ---
     create_marketing_text_sequence(anim_end_frame)
@@ -363,13 +491,15 @@ if __name__ == "__main__":
     light.location = (GRID_SIZE_X * SPACING, -GRID_SIZE_Y * SPACING, GRID_SIZE_Z * SPACING * 2)
     scene_coll.objects.link(light)
     scene = bpy.context.scene
-    scene.render.engine = 'BLENDER_EEVEE'
-    scene.eevee.use_bloom = True
-    scene.eevee.bloom_threshold = 1.0
-    scene.eevee.bloom_intensity = 0.08
-    scene.eevee.bloom_radius = 7
+    setup_render_engine(scene)
 
     # --- Create Marketing Text Sequence ---
     create_marketing_text_sequence(anim_end_frame)
 
+    # Save the finished scene so the launcher can skip regeneration on later renders
+    scene_cache_path = os.environ.get("SCENE_CACHE")
+    if scene_cache_path:
+        print(f"Saving scene cache to {scene_cache_path}")
+        bpy.ops.wm.save_as_mainfile(filepath=scene_cache_path)
+
     print("--- Scene Generation Finished Successfully ---")
\ No newline at end of file